@@ -17,7 +17,6 @@ from btrfs_sxbackup.core import Location
 from btrfs_sxbackup.core import Job
 from btrfs_sxbackup.core import Configuration
 from btrfs_sxbackup.retention import RetentionExpression
-from btrfs_sxbackup import mail
 from btrfs_sxbackup import __version__
 
 _APP_NAME = 'btrfs-sxbackup'
@@ -160,8 +159,9 @@ def main():
             logger.error('%s' % str(ex))
 
         if isinstance(ex, CalledProcessError):
-            if ex.output:
-                output = ex.output.decode().strip()
+            output = ex.output if ex.output else ex.stderr
+            if output:
+                output = output.decode().strip()
                 if len(output) > 0:
                     logger.error('%s' % output)
 
@@ -172,6 +172,9 @@ def main():
         # Email notification
         if email_recipient:
             try:
+                # Deferred import, smtplib/email are only needed on failure
+                from btrfs_sxbackup import mail
+
                 # Format message and send
                 msg = '\n'.join(map(lambda log_record: log_memory_handler.formatter.format(log_record),
                                     log_memory_handler.buffer))
@@ -5,7 +5,9 @@
 # Software Foundation; either version 2 of the License, or (at your option)
 # any later version.
 
+import functools
 import re
+import shlex
 import sys
 import os
 
@@ -23,6 +25,10 @@ class SnapshotName:
     sxbackup snapshot name
     """
 
+    # Fixed-width name format; lexicographic order of formatted names matches
+    # timestamp order, which presorted subvolume listings rely on
+    __FORMAT = 'sx-%Y%m%d-%H%M%S-utc'
+
     __regex = re.compile('^sx-([0-9]{4})([0-9]{2})([0-9]{2})-([0-9]{2})([0-9]{2})([0-9]{2})-utc$', re.IGNORECASE)
 
     def __init__(self, timestamp=None):
@@ -43,9 +49,12 @@ class SnapshotName:
         return self.__timestamp
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def parse(name):
         """
-        Parse snapshot name
+        Parse snapshot name.
+        Results are cached; instances are immutable and source and
+        destination listings largely share the same names
         :param name: Name to parse
         :return: Snapshot
         :rtype: SnapshotName
@@ -67,7 +76,7 @@ class SnapshotName:
 
     def __str__(self):
         """ Create formatted snapshot name """
-        return self.__timestamp.strftime('sx-%Y%m%d-%H%M%S-utc')
+        return self.__timestamp.strftime(SnapshotName.__FORMAT)
 
     def format(self):
         return '%s: %s' % (self, self.__timestamp.astimezone().strftime("%c (%z)"))
@@ -152,7 +161,7 @@ class Snapshot:
 
     def __str__(self):
         """ Create formatted snapshot name """
-        return self.name.timestamp.strftime('sx-%Y%m%d-%H%M%S-utc')
+        return str(self.name)
 
     def format(self):
         return self.name.format()
@@ -177,7 +186,7 @@ class Filesystem:
         currentpath = self.__path
         for x in range(0, len(currentpath.split(os.path.sep))):
             try:
-                ret = shell.exec_check_output('btrfs fi show %s' % currentpath, self.url)
+                ret = shell.exec_check_output('btrfs fi show %s' % shlex.quote(currentpath), self.url)
             except Exception as e:
                 pass
             else:
@@ -6,8 +6,8 @@
 # any later version.
 
 import collections
-import logging
 import math
+import operator
 import re
 from datetime import datetime
 from datetime import timedelta
@@ -317,7 +317,6 @@ class RetentionExpression:
         c'tor
         :param expression: Expression string defining multiple criteria for retaining backups
         """
-        self.__logger = logging.getLogger(self.__class__.__name__)
         expression = str(expression)
 
         # Parse keep expression string
@@ -332,7 +331,7 @@ class RetentionExpression:
         conditions = list(map(lambda x: RetentionExpression.Condition.parse(x), criteria))
 
         # Conditions sorted by age
-        self.__conditions = sorted(conditions, key=lambda c: c.age)
+        self.__conditions = sorted(conditions, key=operator.attrgetter('age'))
 
     def __str__(self):
         return self.__expression_text
@@ -5,39 +5,100 @@
 # Software Foundation; either version 2 of the License, or (at your option)
 # any later version.
 
+import atexit
+import functools
+import hashlib
+import os
+import shlex
+import shutil
 import subprocess
 import logging
 
 
 _logger = logging.getLogger(__name__)
 
+# SSH connection multiplexing can be disabled via environment variable
+_SSH_MUX_DISABLED = bool(os.environ.get('SXBACKUP_DISABLE_SSH_MUX'))
+
+# (url_string, control_path) of master connections established by this process
+_ssh_masters = set()
+
+
+@atexit.register
+def _close_ssh_masters():
+    """ Terminate ssh master connections on interpreter exit so control
+    sockets do not linger beyond their ControlPersist timeout """
+    for url_string, control_path in _ssh_masters:
+        subprocess.call(['ssh', '-o', 'ControlPath=%s' % control_path, '-O', 'exit', url_string],
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+
+
+def _ssh_control_args(url_string):
+    """
+    Create ssh options for connection multiplexing.
+    The master connection is established lazily on first use (ControlMaster=auto)
+    and kept alive (ControlPersist) so subsequent commands to the same host
+    reuse the existing connection instead of paying a full handshake each time
+    :param url_string: user@host string identifying the remote
+    :return: ssh argument list
+    """
+    if _SSH_MUX_DISABLED:
+        return []
+    # Short digest keeps the socket path well below UNIX_PATH_MAX
+    digest = hashlib.sha1(url_string.encode()).hexdigest()[:8]
+    control_path = '/tmp/btrfs-sxbackup-%s-%s.sock' % (os.getuid(), digest)
+    _ssh_masters.add((url_string, control_path))
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % control_path,
+            '-o', 'ControlPersist=60']
+
+
+@functools.lru_cache(maxsize=None)
+def _ssh_prefix_args(username, hostname, port):
+    """
+    ssh argument prefix for a remote host, built once per distinct host and
+    reused for every subsequent command. BatchMode prevents failed
+    authentication from hanging on an interactive password prompt
+    :return: ssh arguments including the user@host target, as a tuple
+    """
+    url_string = hostname if username is None else '%s@%s' % (username, hostname)
+
+    ssh_args = ['ssh', '-o', 'BatchMode=yes',
+                '-o', 'ServerAliveInterval=5', '-o', 'ServerAliveCountMax=3',
+                # Prefer AES-GCM so bulk send/receive streams are encrypted
+                # with AES-NI where available; the trailing entries keep the
+                # connection working against servers without GCM support.
+                # SSH-level compression stays off, send streams barely
+                # compress and the cipher is the cheaper bottleneck
+                '-o', 'Ciphers=aes128-gcm@openssh.com,aes256-gcm@openssh.com,chacha20-poly1305@openssh.com,aes128-ctr',
+                '-o', 'Compression=no']
+    if port is not None:
+        ssh_args += ['-p', '%s' % port]
+    ssh_args += _ssh_control_args(url_string)
+    ssh_args += [url_string]
+
+    return tuple(ssh_args)
+
 
 def build_subprocess_args(cmd, url=None):
     """
     Create subprocess arguments for shell command/args to be executed
     Internally Wraps command into ssh call if url host name is not None
-    :param cmd: Shell command string or argument list
+    :param cmd: Shell command string or list of argv tokens
     :param url: url of remote host
     :return: Subprocess arguments
     """
-    # in case cmd is a regular value, convert to list
-    cmd = cmd if isinstance(cmd, list) else [cmd]
     # wrap into bash or ssh command respectively
     # depending if command is executed locally (host==None) or remotely
-    url_string = None
-    ssh_args = ['ssh', '-o', 'ServerAliveInterval=5', '-o', 'ServerAliveCountMax=3']
-
     if url is not None and url.hostname is not None:
-        url_string = url.hostname
-        if url.username is not None:
-            url_string = '%s@%s' % (url.username, url.hostname)
-        if url.port is not None:
-            ssh_args += ['-p', '%s' % url.port]
-
-    ssh_args += ['%s' % url_string]
-
-    subprocess_args = ['bash', '-c'] + cmd if url_string is None else \
-        ssh_args + cmd
+        # the remote shell re-tokenizes its command, so argv lists are
+        # joined into a safely quoted command string
+        cmd_str = cmd if isinstance(cmd, str) else ' '.join(map(shlex.quote, cmd))
+        subprocess_args = list(_ssh_prefix_args(url.username, url.hostname, url.port)) + [cmd_str]
+    else:
+        # argv lists are executed directly, only command strings need a shell
+        subprocess_args = list(cmd) if isinstance(cmd, list) else ['bash', '-c', cmd]
 
     _logger.debug(subprocess_args)
 
@@ -54,6 +115,20 @@ def exec_check_output(cmd, url=None) -> bytes:
     return subprocess.check_output(build_subprocess_args(cmd, url), stderr=subprocess.STDOUT)
 
 
+def exec_run(cmd, url=None):
+    """
+    Wrapper for subprocess.run, for commands whose output is discarded.
+    Stdout goes straight to /dev/null instead of being piped and buffered;
+    stderr is captured and attached to the CalledProcessError on failure
+    :param cmd: Command text
+    :param url: URL
+    """
+    subprocess.run(build_subprocess_args(cmd, url),
+                   check=True,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.PIPE)
+
+
 def exec_call(cmd, url=None) -> int:
     """
     Wrapper for subprocess.call
@@ -64,17 +139,19 @@ def exec_call(cmd, url=None) -> int:
     return subprocess.call(build_subprocess_args(cmd, url), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
 
 
+@functools.lru_cache(maxsize=None)
 def exists(command, url=None):
     """
-    Check if shell command exists
+    Check if shell command exists.
+    Results are cached for the lifetime of the process
     :param command: Command to verify
     :param url: url of remote host
-    :return: True if location exists, otherwise False
+    :return: True if command exists, otherwise False
     """
-    type_prc = subprocess.Popen(build_subprocess_args(['type ' + command], url),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                shell=False)
-    return type_prc.wait() == 0
+    if url is None or url.hostname is None:
+        # Plain PATH scan, no subprocess needed
+        return shutil.which(command) is not None
+
+    return exec_call('command -v %s > /dev/null' % shlex.quote(command), url) == 0
 
 
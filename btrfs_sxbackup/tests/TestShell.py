@@ -0,0 +1,31 @@
+# Copyright (c) 2014 Marco Schindler
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+
+import unittest
+from urllib.parse import urlsplit
+
+from btrfs_sxbackup import shell
+
+
+class TestShell(unittest.TestCase):
+    def test_build_subprocess_args_local_string(self):
+        self.assertEqual(shell.build_subprocess_args('btrfs sub list /'),
+                         ['bash', '-c', 'btrfs sub list /'])
+
+    def test_build_subprocess_args_local_list(self):
+        self.assertEqual(shell.build_subprocess_args(['btrfs', 'sub', 'list', '/']),
+                         ['btrfs', 'sub', 'list', '/'])
+
+    def test_build_subprocess_args_remote_string(self):
+        args = shell.build_subprocess_args('btrfs sub list /', urlsplit('ssh://user@host/path'))
+        self.assertEqual(args[0], 'ssh')
+        self.assertEqual(args[-2], 'user@host')
+        self.assertEqual(args[-1], 'btrfs sub list /')
+
+    def test_build_subprocess_args_remote_list(self):
+        args = shell.build_subprocess_args(['touch', '/path/with space'], urlsplit('ssh://user@host/path'))
+        self.assertEqual(args[-1], "touch '/path/with space'")